@@ -13,6 +13,9 @@ class BotConfig:
     # Supabase Configuration
     SUPABASE_URL: str = os.getenv("SUPABASE_URL", "")
     SUPABASE_KEY: str = os.getenv("SUPABASE_KEY", "")
+
+    # Redis Configuration (optional, shares conversation state between bot workers)
+    REDIS_URL: str = os.getenv("REDIS_URL", "")
     
     def validate(self):
         """Validate configuration"""
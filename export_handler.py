@@ -1,79 +1,241 @@
 # export_handler.py
-import pandas as pd
-import matplotlib.pyplot as plt
+import asyncio
+import csv
+import functools
+import hashlib
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import os
-from datetime import datetime, timedelta
+from io import BytesIO
+from datetime import date, datetime
 
-def fetch_user_expenditures(supabase, user_id, days=7):
-    from datetime import datetime, timedelta
+EXPORT_PAGE_SIZE = 500
 
-    end_date = datetime.utcnow().date()
-    start_date = end_date - timedelta(days=days)
+# Telegram downscales photos for display, so anything much above screen resolution is wasted work
+CHART_DPI = 120
 
-    # Fetch all categories for lookup
+# Rendered weekly charts, keyed by user, ISO week and a digest of the plotted data
+SUMMARY_CACHE_DIR = os.path.join(tempfile.gettempdir(), "wsum_cache")
+SUMMARY_CACHE_MAX_FILES = 512
+
+def fetch_category_map(supabase):
     cat_records = supabase.table("base_categories").select("id,name").execute().data
-    cat_map = {c["id"]: c["name"] for c in cat_records}
-
-    # Fetch expenditures for user
-    res = supabase.table("expenditures") \
-        .select("*") \
-        .eq("user_id", user_id) \
-        .gte("date", str(start_date)) \
-        .lte("date", str(end_date)) \
-        .execute()
-    records = res.data if hasattr(res, "data") else res
-    df = pd.DataFrame(records)
-
-    # Map category_id to name
-    if not df.empty:
-        df['category'] = df['category_id'].map(cat_map).fillna('Unknown')
-    else:
-        df['category'] = []
-
-    return df
-
-def generate_weekly_summary(supabase, user_id):
-    df = fetch_user_expenditures(supabase, user_id, days=7)
-    if df.empty:
-        return None, "No expenditures found for the past 7 days.", None
+    return {c["id"]: c["name"] for c in cat_records}
+
+def fetch_user_expenditures(supabase, telegram_id, days=7):
+    """Get (date, amount, category_name) totals per day and category for the user's last `days` days"""
+    res = supabase.rpc("weekly_summary_data", {"p_telegram_id": telegram_id, "p_days": days}).execute()
+    return res.data if hasattr(res, "data") else res
+
+# matplotlib and pyarrow are imported inside the functions that need them,
+# so starting the bot does not pay for them until a chart or export is requested
+
+def _render_png(fig):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    canvas = FigureCanvasAgg(fig)
+    fig.tight_layout()
+    buf = BytesIO()
+    canvas.print_png(buf)
+    buf.seek(0)
+    return buf
+
+def _render_trend(daily):
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
 
     # Trendline (daily spending)
-    df['date'] = pd.to_datetime(df['date'])
-    daily = df.groupby('date')['amount'].sum().reset_index()
-    trend_img_path = f"trend_{user_id}.png"
-    plt.figure(figsize=(6, 3))
-    plt.plot(daily['date'], daily['amount'], marker='o')
-    plt.title('Weekly Expenditure Trend')
-    plt.xlabel('Date')
-    plt.ylabel('Amount')
-    plt.tight_layout()
-    plt.savefig(trend_img_path)
-    plt.close()
+    fig = Figure(figsize=(6, 3), dpi=CHART_DPI)
+    ax = fig.subplots()
+    dates, amounts = zip(*daily)
+    ax.plot(dates, amounts, marker='o')
+    ax.set_title('Weekly Expenditure Trend')
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Amount')
+    return _render_png(fig)
+
+def _render_pie(cat_sum):
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
 
     # Pie chart (category breakdown)
-    cat_sum = df.groupby('category')['amount'].sum()
-    pie_img_path = f"pie_{user_id}.png"
-    plt.figure(figsize=(4.5, 4.5))
-    cat_sum.plot.pie(autopct='%1.1f%%', startangle=90, counterclock=False)
-    plt.title('Expenditure by Category')
-    plt.ylabel('')
-    plt.tight_layout()
-    plt.savefig(pie_img_path)
-    plt.close()
+    fig = Figure(figsize=(4.5, 4.5), dpi=CHART_DPI)
+    ax = fig.subplots()
+    ax.pie([amt for _, amt in cat_sum], labels=[cat for cat, _ in cat_sum], autopct='%1.1f%%', startangle=90, counterclock=False)
+    ax.set_title('Expenditure by Category')
+    return _render_png(fig)
+
+# The two weekly charts are independent, so each render gets its own worker
+_chart_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chart")
+
+def _summary_cache_path(user_id, iso_week, digest, chart):
+    return os.path.join(SUMMARY_CACHE_DIR, f"{user_id}_{iso_week}_{digest}.{chart}.png")
+
+@functools.lru_cache(maxsize=512)
+def _load_cached_chart(user_id, iso_week, digest, chart):
+    """Read a cached chart PNG from disk; raises FileNotFoundError on a miss"""
+    path = _summary_cache_path(user_id, iso_week, digest, chart)
+    with open(path, "rb") as f:
+        png = f.read()
+    os.utime(path)  # mark as recently used for the sweep
+    return png
+
+def _sweep_summary_cache():
+    """Remove the least recently used files once the cache directory grows too large"""
+    entries = []
+    for entry in os.scandir(SUMMARY_CACHE_DIR):
+        try:
+            entries.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            pass  # removed by a concurrent sweep
+    if len(entries) <= SUMMARY_CACHE_MAX_FILES:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - SUMMARY_CACHE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _cached_render(chart, render, data, user_id, iso_week, digest):
+    try:
+        return _load_cached_chart(user_id, iso_week, digest, chart)
+    except FileNotFoundError:
+        pass
+
+    png = render(data).getvalue()
+    os.makedirs(SUMMARY_CACHE_DIR, exist_ok=True)
+    path = _summary_cache_path(user_id, iso_week, digest, chart)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(png)
+    os.replace(tmp_path, path)
+    _sweep_summary_cache()
+    return png
+
+async def generate_weekly_summary(supabase, telegram_id, run_db=asyncio.to_thread):
+    """Build the weekly charts and summary text; `run_db(fn, *args)` runs the blocking Supabase query"""
+    records = await run_db(fetch_user_expenditures, supabase, telegram_id, 7)
+    if not records:
+        return None, "No expenditures found for the past 7 days.", None
+
+    # Rows are already summed per day and category, so this only rolls them up each way
+    daily_sum = defaultdict(float)
+    category_sum = defaultdict(float)
+    for r in records:
+        amount = float(r['amount'])
+        daily_sum[date.fromisoformat(str(r['date'])[:10])] += amount
+        category_sum[r['category_name']] += amount
+    daily = sorted(daily_sum.items())
+    cat_sum = sorted(category_sum.items())
+
+    # Identical data within the same week reuses the previously rendered charts
+    year, week, _ = datetime.utcnow().date().isocalendar()
+    iso_week = f"{year}W{week:02d}"
+    digest = hashlib.blake2b(repr((CHART_DPI, daily, cat_sum)).encode(), digest_size=8).hexdigest()
+
+    # Rendering is CPU-bound, so keep it off the event loop and draw both charts at once
+    loop = asyncio.get_running_loop()
+    trend_png, pie_png = await asyncio.gather(
+        loop.run_in_executor(_chart_executor, _cached_render, "trend", _render_trend, daily, telegram_id, iso_week, digest),
+        loop.run_in_executor(_chart_executor, _cached_render, "pie", _render_pie, cat_sum, telegram_id, iso_week, digest),
+    )
+    trend_buf, pie_buf = BytesIO(trend_png), BytesIO(pie_png)
 
     # Summary text
-    total = df['amount'].sum()
+    total = sum(amt for _, amt in cat_sum)
     summary_text = f"Total spent this week: <b>{total:.2f}</b> SGD\n\n"
-    summary_text += "\n".join([f"<b>{cat}:</b> {amt:.2f}" for cat, amt in cat_sum.items()])
+    summary_text += "\n".join([f"<b>{cat}:</b> {amt:.2f}" for cat, amt in cat_sum])
+
+    # Return both images as in-memory PNGs: trend and pie
+    return trend_buf, summary_text, pie_buf
+
+
+def iter_expenditure_pages(supabase, telegram_id, days=7, page=EXPORT_PAGE_SIZE):
+    """Yield the user's expenditures in pages of at most `page` rows.
+
+    Exporters write each page as it arrives, so memory stays bounded by the page size.
+    """
+    offset = 0
+    while True:
+        res = supabase.rpc("export_rows", {
+            "p_telegram_id": telegram_id,
+            "p_days": days,
+            "p_offset": offset,
+            "p_limit": page,
+        }).execute()
+        records = res.data if hasattr(res, "data") else res
+        if records:
+            yield records
+        if len(records) < page:
+            break
+        offset += page
+
+
+def export_csv(supabase, telegram_id, days=7, cat_map=None):
+    if cat_map is None:
+        cat_map = fetch_category_map(supabase)
+
+    csv_path = f"weekly_summary_{telegram_id}.csv"
+    writer = None
+    with open(csv_path, "w", newline="", buffering=1 << 20) as f:
+        for page in iter_expenditure_pages(supabase, telegram_id, days=days):
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(page[0].keys()) + ["category"])
+                writer.writeheader()
+            for row in page:
+                row["category"] = cat_map.get(row.get("category_id"), "Unknown")
+            writer.writerows(page)
+
+    if writer is None:
+        os.remove(csv_path)
+        return None
+    return csv_path
+
+
+def export_parquet(supabase, telegram_id, days=7, cat_map=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if cat_map is None:
+        cat_map = fetch_category_map(supabase)
 
-    # Return both images: trend and pie
-    return trend_img_path, summary_text, pie_img_path
+    # Declared up front so every page is written with the same types, even one whose values are all null
+    schema = pa.schema([
+        ("id", pa.string()),
+        ("user_id", pa.string()),
+        ("date", pa.date32()),
+        ("amount", pa.float64()),
+        ("currency", pa.string()),
+        ("category_id", pa.int64()),
+        ("category", pa.string()),
+        ("description", pa.string()),
+        ("input_method", pa.string()),
+    ])
 
+    parquet_path = f"weekly_summary_{telegram_id}.parquet"
+    writer = None
+    try:
+        for page in iter_expenditure_pages(supabase, telegram_id, days=days):
+            for row in page:
+                row["category"] = cat_map.get(row.get("category_id"), "Unknown")
+                if row.get("id") is not None:
+                    row["id"] = str(row["id"])
+                if row.get("date"):
+                    row["date"] = date.fromisoformat(str(row["date"])[:10])
+                if row.get("amount") is not None:
+                    row["amount"] = float(row["amount"])
+            if writer is None:
+                writer = pq.ParquetWriter(parquet_path, schema, compression="zstd")
+            writer.write_table(pa.Table.from_pylist(page, schema=schema))
+    finally:
+        if writer is not None:
+            writer.close()
 
-def export_csv(supabase, user_id, days=7):
-    df = fetch_user_expenditures(supabase, user_id, days=days)
-    if df.empty:
+    if writer is None:
         return None
-    csv_path = f"weekly_summary_{user_id}.csv"
-    df.to_csv(csv_path, index=False)
-    return csv_path
\ No newline at end of file
+    return parquet_path
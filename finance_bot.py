@@ -1,28 +1,33 @@
 import os
+import asyncio
 import logging
 import json
+import random
 import base64
-import requests
+import httpx
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional, Dict, List
-import pandas as pd
 from io import BytesIO
 from dotenv import load_dotenv
-import re
+import time
 
+from PIL import Image
+from postgrest.exceptions import APIError
+from postgrest.utils import SyncClient as PostgrestSession
 from supabase import create_client, Client as SupabaseClient
+from supabase.lib.client_options import ClientOptions
 
 # Load environment variables
 load_dotenv()
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
+    AIORateLimiter, Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
 
-from export_handler import generate_weekly_summary, export_csv
-
 from config import BotConfig
 
 config = BotConfig()
@@ -35,138 +40,506 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Receipts are downscaled to fit this box before being sent to OpenAI;
+# they are sent with detail "low", which reads the image at 512px anyway
+RECEIPT_MAX_SIDE = 768
+
+def _compress_receipt(image_data: BytesIO) -> memoryview:
+    """Downscale a receipt photo and re-encode it as a compact JPEG, returned without copying the buffer"""
+    image_data.seek(0)
+    img = Image.open(image_data)
+    img.thumbnail((RECEIPT_MAX_SIDE, RECEIPT_MAX_SIDE))
+    out = BytesIO()
+    img.convert("RGB").save(out, "JPEG", quality=80, optimize=True)
+    return out.getbuffer()
+
+_JSON_DECODER = json.JSONDecoder()
+
+def _extract_json(content: str) -> Optional[dict]:
+    """Parse the JSON object in a model reply, skipping any text around it"""
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        pass
+    # Scan forward from each '{' until one decodes as a complete object
+    start = content.find('{')
+    while start != -1:
+        try:
+            obj, _ = _JSON_DECODER.raw_decode(content, start)
+            return obj
+        except json.JSONDecodeError:
+            start = content.find('{', start + 1)
+    return None
+
+# At most this many OpenAI requests are in flight; 429/5xx responses are retried after each backoff in turn
+OPENAI_MAX_CONCURRENCY = 8
+OPENAI_RETRY_BACKOFF = (0.5, 1, 2)
+OPENAI_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def _retry_after(response: httpx.Response, backoff: float) -> float:
+    """Seconds to wait before retrying: the server's Retry-After if given, else the backoff, plus jitter"""
+    try:
+        delay = max(float(response.headers["Retry-After"]), backoff)
+    except (KeyError, ValueError):
+        delay = backoff
+    return delay + random.uniform(0, 0.25)
+
+# base_categories is effectively static, so it is only refetched after this many seconds
+CATEGORY_CACHE_TTL = 600
+
+# Receipts from the same chat arriving within this window share one GPT-4V request, up to this many images
+RECEIPT_BATCH_WINDOW = 0.5
+RECEIPT_BATCH_SIZE = 8
+
+# Blocking Supabase calls run on a dedicated pool with one kept-alive connection per worker
+SUPABASE_WORKERS = 8
+
 class FinanceBot:
     def __init__(self, config: BotConfig):
         self.config = config
-        self.supabase: SupabaseClient = create_client(config.SUPABASE_URL, config.SUPABASE_KEY)
+        self.supabase: SupabaseClient = create_client(
+            config.SUPABASE_URL,
+            config.SUPABASE_KEY,
+            options=ClientOptions(postgrest_client_timeout=10, storage_client_timeout=10),
+        )
+        self._use_pooled_postgrest_session()
+        self._db_executor = ThreadPoolExecutor(max_workers=SUPABASE_WORKERS, thread_name_prefix="supabase")
+        self._cat_cache = None
+        self._cat_cache_ts = 0
+        self._cat_by_name: Dict[str, int] = {}
+        self._cat_by_id: Dict[int, str] = {}
+        # Bumped on every category refetch so derived caches know when to rebuild
+        self._cat_version = 0
+        self._kb_cache: Optional[InlineKeyboardMarkup] = None
+        self._kb_version = -1
+        # telegram_id -> users.id; a user's uuid never changes once created
+        self._uid_cache: Dict[int, str] = {}
+        # Expenditure rows waiting for the next batched insert, with the futures of their callers
+        self._pending_tx: List[tuple] = []
+        self._flush_lock = asyncio.Lock()
+        self._insert_tasks = set()
+        # chat_id -> (image_url, future) pairs waiting for that chat's next GPT-4V batch, and its flush timer
+        self._receipt_batches: Dict[int, tuple] = {}
+        self._receipt_tasks = set()
+        # The receipt prompt and headers never change, so only the images are added per request
+        self._prompt_text = """Analyze these receipt/bill images and extract the following information for each one in JSON format. Each image is preceded by its image_index; echo it in that image's result:
+{
+    "receipts": [
+        {
+            "image_index": <image_index_of_the_receipt>,
+            "amount": <total_amount_as_number>,
+            "merchant": "<merchant_name>",
+            "category": "<best_matching_category>",
+            "date": "<date_in_YYYY-MM-DD_format>",
+            "items": ["<item1>", "<item2>"],
+            "currency": "<currency_symbol_or_code>"
+        }
+    ]
+}
+For category, choose from: Food & Dining, Transportation, Shopping, Entertainment, Bills & Utilities, Healthcare, Travel, Other Expenses
+If you can't determine a field, use null or empty string.
+"""
+        self._openai_sem = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+        self._openai_headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.config.OPENAI_API_KEY}"
+        }
+        # Shared async client so OpenAI calls reuse pooled connections and never block the event loop
+        self._http = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=5.0), http2=True)
+
+    def _use_pooled_postgrest_session(self):
+        """Swap the PostgREST session for one that multiplexes requests over kept-alive HTTP/2 connections"""
+        postgrest = self.supabase.postgrest
+        session = postgrest.session
+        postgrest.session = PostgrestSession(
+            base_url=session.base_url,
+            headers=session.headers,
+            timeout=session.timeout,
+            http2=True,
+            limits=httpx.Limits(max_connections=SUPABASE_WORKERS, max_keepalive_connections=SUPABASE_WORKERS),
+        )
+        session.close()
+
+    async def _run_db(self, fn, *args):
+        """Run a blocking Supabase call on the dedicated worker pool"""
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, fn, *args)
+
+    async def warm_up(self):
+        """Prefetch base_categories and build the category picker so the first command does not wait on them"""
+        try:
+            await self._get_category_keyboard()
+        except Exception as e:
+            logger.warning(f"Could not prefetch categories: {e}")
+
+    async def aclose(self):
+        for _, timer in self._receipt_batches.values():
+            timer.cancel()
+        for task in self._receipt_tasks:
+            task.cancel()
+        await self._http.aclose()
+        # Let in-flight expenditure inserts finish so their callers get a result
+        await asyncio.gather(*self._insert_tasks, return_exceptions=True)
+        self._db_executor.shutdown(wait=True)
+        self.supabase.postgrest.aclose()
     
-    def add_user(self, user_id: int, username: str):
-        self.supabase.table("users").upsert(
+    async def add_user(self, user_id: int, username: str):
+        rows = (await self._run_db(self.supabase.table("users").upsert(
             {
                 "telegram_id": user_id,
                 "username": username,
             },
             on_conflict=["telegram_id"] 
-        ).execute()
+        ).execute)).data
+        if rows:
+            self._uid_cache[user_id] = rows[0]["id"]
 
-    def add_transaction(self, user_id: int, amount: float, category: str, description: str, date: str = None):
+    def _resolve_user_uuid(self, telegram_id: int) -> Optional[str]:
+        """Get the Supabase user uuid for a telegram_id, querying only on a cache miss"""
+        user_uuid = self._uid_cache.get(telegram_id)
+        if user_uuid is None:
+            user = self.supabase.table("users").select("id").eq("telegram_id", telegram_id).single().execute().data
+            if not user:
+                return None
+            user_uuid = self._uid_cache[telegram_id] = user["id"]
+        return user_uuid
+
+    async def add_transaction(self, user_id: int, amount: float, category: str, description: str, date: str = None):
         """Add a new transaction to Supabase using category_id"""
         if date is None:
             date = datetime.now().strftime('%Y-%m-%d')
-        # Fetch user uuid
-        user = self.supabase.table("users").select("id").eq("telegram_id", user_id).single().execute().data
-        if not user:
-            logger.error(f"Supabase user not found for telegram_id {user_id}")
-            return
+        await self._load_categories()
         category_id = self.get_category_id(category)
         if not category_id:
             logger.error(f"Category '{category}' not found in base_categories.")
             return
-        # Insert expenditure with category_id
-        self.supabase.table("expenditures").insert({
-            "user_id": user["id"],
-            "amount": amount,
-            "currency": "SGD",
-            "date": date,
-            "category_id": category_id,
-            "description": description,
-            "input_method": "manual",
-        }).execute()
+        user_uuid = self._uid_cache.get(user_id)
+        if user_uuid:
+            # Both ids are known locally, so the row can join a batched insert
+            await self._queue_expenditure({
+                "user_id": user_uuid,
+                "amount": amount,
+                "currency": "SGD",
+                "date": date,
+                "category_id": category_id,
+                "description": description,
+                "input_method": "manual",
+            })
+            return
+        # Let the database resolve the user in the same round-trip as the insert
+        rows = (await self._run_db(self.supabase.rpc("insert_expenditure", {
+            "p_telegram_id": user_id,
+            "p_amount": amount,
+            "p_category": category,
+            "p_description": description,
+            "p_date": date,
+        }).execute)).data
+        if not rows:
+            logger.error(f"Supabase user not found for telegram_id {user_id}")
+            return
+        self._uid_cache[user_id] = rows[0]["user_id"]
+
+    async def _queue_expenditure(self, row: dict):
+        """Queue an expenditure row and return once an insert containing it has completed.
+
+        Rows queued while an insert is in flight are sent together by the next
+        caller to take the lock, so bursts of saves share one request.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending_tx.append((row, future))
+        async with self._flush_lock:
+            # The row may already be in an insert whose caller was cancelled; then just wait for it
+            if any(f is future for _, f in self._pending_tx):
+                batch, self._pending_tx = self._pending_tx, []
+                # Shielded so that cancelling this caller does not abandon an insert the
+                # database may still commit; the task resolves every caller in the batch
+                task = asyncio.create_task(self._insert_expenditure_batch(batch))
+                self._insert_tasks.add(task)
+                task.add_done_callback(self._insert_tasks.discard)
+                try:
+                    await asyncio.shield(task)
+                except asyncio.CancelledError:
+                    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+                    raise
+        await future
+
+    async def _insert_expenditure_batch(self, batch: List[tuple]):
+        """Insert the rows of a batch together, falling back to one insert per row if the database rejects it"""
+        try:
+            await self._run_db(self.supabase.table("expenditures").insert([r for r, _ in batch]).execute)
+        except APIError as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # One bad row should only fail its own caller
+            logger.warning(f"Batched insert of {len(batch)} expenditures failed, inserting individually: {e}")
+            results = await asyncio.gather(
+                *(self._run_db(self.supabase.table("expenditures").insert(r).execute) for r, _ in batch),
+                return_exceptions=True,
+            )
+            for (_, f), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    f.set_exception(result)
+                else:
+                    f.set_result(None)
+        except Exception as e:
+            # A timeout or dropped connection may come after the batch was committed, so it is not replayed
+            for _, f in batch:
+                f.set_exception(e)
+        else:
+            for _, f in batch:
+                f.set_result(None)
+
+    async def add_transactions_bulk(self, user_id: int, transactions: List[dict]) -> int:
+        """Insert many transactions in a single request; returns how many rows were sent"""
+        # A cached uuid is returned on the loop; only a miss needs the worker pool
+        user_uuid = self._uid_cache.get(user_id) or await self._run_db(self._resolve_user_uuid, user_id)
+        if not user_uuid:
+            logger.error(f"Supabase user not found for telegram_id {user_id}")
+            return 0
+        today = datetime.now().strftime('%Y-%m-%d')
+        await self._load_categories()
+        rows = []
+        for t in transactions:
+            category_id = self.get_category_id(t["category"])
+            if not category_id:
+                logger.error(f"Category '{t['category']}' not found in base_categories.")
+                continue
+            rows.append({
+                "user_id": user_uuid,
+                "amount": t["amount"],
+                "currency": "SGD",
+                "date": t.get("date") or today,
+                "category_id": category_id,
+                "description": t.get("description", ""),
+                "input_method": "manual",
+            })
+        if rows:
+            await self._run_db(self.supabase.table("expenditures").insert(rows).execute)
+        return len(rows)
+
+    def _categories_stale(self) -> bool:
+        return self._cat_cache is None or time.monotonic() - self._cat_cache_ts >= CATEGORY_CACHE_TTL
+
+    def _categories(self) -> List[dict]:
+        """Return base_categories rows, refetching them once the cache TTL has expired"""
+        if self._categories_stale():
+            cats = self.supabase.table("base_categories").select("id,name,icon").execute().data
+            self._cat_by_name = {c['name']: c['id'] for c in cats}
+            self._cat_by_id = {c['id']: c['name'] for c in cats}
+            self._cat_cache = cats
+            self._cat_cache_ts = time.monotonic()
+            self._cat_version += 1
+        return self._cat_cache
+
+    async def _load_categories(self) -> List[dict]:
+        """Like _categories, but a refetch runs on the worker pool instead of the event loop"""
+        if self._categories_stale():
+            return await self._run_db(self._categories)
+        return self._cat_cache
 
     def get_category_id(self, category_name: str) -> int:
         """Get category_id for a given category name from base_categories table."""
-        cat = self.supabase.table("base_categories").select("id").eq("name", category_name).single().execute().data
-        return cat["id"] if cat else None
+        self._categories()
+        return self._cat_by_name.get(category_name)
+
+    async def load_category_map(self) -> Dict[int, str]:
+        """Get a category_id -> category name mapping, refetching on the worker pool if stale"""
+        await self._load_categories()
+        return self._cat_by_id
 
     def get_categories(self) -> List[tuple]:
-        cats = self.supabase.table("base_categories").select("name,icon,id").execute().data
-        return [(c['name'], c.get('icon', ''), c['id']) for c in cats]
+        return [(c['name'], c.get('icon', ''), c['id']) for c in self._categories()]
 
-    def get_user_transactions(self, user_id: int, days: int = 30) -> List[dict]:
-        """Get user transactions from Supabase for specified period"""
-        user = self.supabase.table("users").select("id").eq("telegram_id", user_id).single().execute().data
-        if not user:
+    async def _get_category_keyboard(self) -> InlineKeyboardMarkup:
+        """Get the two-column category picker, rebuilt only when the categories change"""
+        await self._load_categories()
+        categories = self.get_categories()
+        if self._kb_cache is None or self._kb_version != self._cat_version:
+            keyboard = []
+            for i in range(0, len(categories), 2):
+                row = []
+                for j in range(2):
+                    if i + j < len(categories):
+                        cat_name, emoji, _ = categories[i + j]
+                        row.append(InlineKeyboardButton(
+                            f"{emoji} {cat_name}",
+                            callback_data=f"category_{cat_name}"
+                        ))
+                keyboard.append(row)
+            self._kb_cache = InlineKeyboardMarkup(keyboard)
+            self._kb_version = self._cat_version
+        return self._kb_cache
+
+    async def get_user_transactions(self, user_id: int, days: int = 30, limit: int = 1000) -> List[dict]:
+        """Get the user's latest transactions from Supabase for specified period, newest first"""
+        user_uuid = self._uid_cache.get(user_id) or await self._run_db(self._resolve_user_uuid, user_id)
+        if not user_uuid:
             return []
-        user_uuid = user['id']
         date_limit = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
-        query = self.supabase.table("expenditures").select("*").eq("user_id", user_uuid).gte("date", date_limit)
-        data = query.order("date", desc=True).limit(1000).execute().data
+        # Embed the category name through the category_id foreign key instead of a second lookup
+        query = self.supabase.table("expenditures") \
+            .select("amount,description,date,base_categories(name)") \
+            .eq("user_id", user_uuid) \
+            .gte("date", date_limit)
+        data = (await self._run_db(query.order("date", desc=True).limit(limit).execute)).data
         return data
 
-    async def process_image_with_gpt4v(self, image_data: bytes) -> Dict:
-        """Process receipt image using GPT-4V to extract transaction details"""
+    async def process_image_with_gpt4v(self, image_data: memoryview, chat_id: int) -> Dict:
+        """Process receipt image using GPT-4V to extract transaction details.
+
+        Receipts sent to the same chat close together share a single GPT-4V
+        request; this waits for the batch containing this image.
+        """
         if not self.config.OPENAI_API_KEY:
             return {"error": "OpenAI API key not configured"}
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.config.OPENAI_API_KEY}"
-        }
+        base64_image = base64.b64encode(image_data).decode('ascii')
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if chat_id not in self._receipt_batches:
+            self._receipt_batches[chat_id] = ([], loop.call_later(RECEIPT_BATCH_WINDOW, self._flush_receipts, chat_id))
+        batch, _ = self._receipt_batches[chat_id]
+        batch.append((f"data:image/jpeg;base64,{base64_image}", future))
+        if len(batch) >= RECEIPT_BATCH_SIZE:
+            self._flush_receipts(chat_id)
+        return await future
+
+    def _flush_receipts(self, chat_id: int):
+        """Send a chat's queued receipts in the background"""
+        batch, timer = self._receipt_batches.pop(chat_id)
+        timer.cancel()
+        task = asyncio.create_task(self._process_receipt_batch(batch))
+        self._receipt_tasks.add(task)
+        task.add_done_callback(self._receipt_tasks.discard)
+
+    async def _process_receipt_batch(self, batch: List[tuple]):
+        image_urls = [image_url for image_url, _ in batch]
+        try:
+            results = await self._extract_receipts(image_urls)
+        except Exception as e:
+            # The request itself failed, so retrying each image would only multiply the load
+            logger.error(f"Error processing image with GPT-4V: {e}")
+            results = [{"error": str(e)}] * len(batch)
+        else:
+            if len(batch) > 1:
+                # Images the batched reply did not account for get a request of their own
+                retry = [i for i, result in enumerate(results) if result is None]
+                singles = await asyncio.gather(
+                    *(self._extract_receipts([image_urls[i]]) for i in retry), return_exceptions=True
+                )
+                for i, single in zip(retry, singles):
+                    if isinstance(single, Exception):
+                        logger.error(f"Error processing image with GPT-4V: {single}")
+                        results[i] = {"error": str(single)}
+                    else:
+                        results[i] = single[0]
+            results = [r if r is not None else {"error": "Could not parse receipt"} for r in results]
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _extract_receipts(self, image_urls: List[str]) -> List[Optional[Dict]]:
+        """Send one GPT-4V request for all images; returns one result per image, in order.
+
+        An image the reply has no unambiguous result for is None. Raises if the
+        request fails or the reply is not a list of receipts.
+        """
+        content = [
+            {"type": "text", "text": self._prompt_text},
+            {"type": "text", "text": f"There are {len(image_urls)} images; return exactly {len(image_urls)} receipts."},
+        ]
+        for i, image_url in enumerate(image_urls):
+            content.append({"type": "text", "text": f"image_index {i}:"})
+            content.append({"type": "image_url", "image_url": {"url": image_url, "detail": "low"}})
         payload = {
             "model": "gpt-4o",
             "messages": [
                 {
                     "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": """Analyze this receipt/bill image and extract the following information in JSON format:
-                            {
-                                "amount": <total_amount_as_number>,
-                                "merchant": "<merchant_name>",
-                                "category": "<best_matching_category>",
-                                "date": "<date_in_YYYY-MM-DD_format>",
-                                "items": ["<item1>", "<item2>"],
-                                "currency": "<currency_symbol_or_code>"
-                            }
-                            For category, choose from: Food & Dining, Transportation, Shopping, Entertainment, Bills & Utilities, Healthcare, Travel, Other Expenses
-                            If you can't determine a field, use null or empty string.
-                            """
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
+                    "content": content
                 }
             ],
-            "max_tokens": 300
+            "response_format": {"type": "json_object"},
+            "max_tokens": 300 * len(image_urls),
+            "stream": True
         }
-        try:
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-            response.raise_for_status()
-            result = response.json()
-            content = result['choices'][0]['message']['content']
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                return {"error": "Could not parse receipt"}
-        except Exception as e:
-            logger.error(f"Error processing image with GPT-4V: {e}")
-            return {"error": str(e)}
+        # Serialise once with orjson rather than letting httpx escape the base64 string via stdlib json
+        body = orjson.dumps(payload)
+        async with self._openai_sem:
+            for backoff in (*OPENAI_RETRY_BACKOFF, None):
+                async with self._http.stream(
+                    "POST",
+                    "https://api.openai.com/v1/chat/completions",
+                    headers=self._openai_headers,
+                    content=body
+                ) as response:
+                    if backoff is None or response.status_code not in OPENAI_RETRY_STATUSES:
+                        response.raise_for_status()
+                        parsed = await self._read_streamed_json(response)
+                        break
+                    delay = _retry_after(response, backoff)
+                logger.warning(f"OpenAI returned {response.status_code}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        receipts = parsed.get("receipts") if isinstance(parsed, dict) else None
+        if not isinstance(receipts, list):
+            raise ValueError("Could not parse receipt")
+        # Match results to images by the echoed image_index, never by position;
+        # an index claimed twice is ambiguous, so neither claim is trusted
+        results: List[Optional[Dict]] = [None] * len(image_urls)
+        claimed = set()
+        for receipt in receipts:
+            if not isinstance(receipt, dict):
+                continue
+            index = receipt.pop("image_index", None)
+            if isinstance(index, int) and 0 <= index < len(image_urls):
+                results[index] = None if index in claimed else receipt
+                claimed.add(index)
+        return results
+
+    @staticmethod
+    async def _read_streamed_json(response: httpx.Response) -> Optional[dict]:
+        """Accumulate streamed completion deltas, returning as soon as they form a complete JSON object"""
+        parts = []
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[6:]
+            if data == "[DONE]":
+                break
+            choices = orjson.loads(data).get("choices")
+            delta = choices[0]["delta"].get("content") if choices else None
+            if not delta:
+                continue
+            parts.append(delta)
+            if "}" not in delta:
+                continue
+            content = "".join(parts)
+            start = content.find("{")
+            if start == -1:
+                continue
+            try:
+                obj, _ = _JSON_DECODER.raw_decode(content, start)
+                return obj  # leaving the stream early closes the connection
+            except json.JSONDecodeError:
+                pass
+        return _extract_json("".join(parts))
 
 class BotHandlers:
+    TRANSACTION_EMOJI = "💵"
+
     def __init__(self, finance_bot: FinanceBot):
         self.finance_bot = finance_bot
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        self.finance_bot.add_user(user.id, user.username or "")
+        await self.finance_bot.add_user(user.id, user.username or "")
         welcome_text = (
             "<b>🏦 Finance Tracker Bot</b>\n\n"
             f"Hello <b>{user.username or 'there'}</b>! I'm here to help you track your finances.\n\n"
             "<b>Available Commands:</b>\n"
             "💵 <code>/add_transaction</code> - Add a transaction\n"
             "📋 <code>/recent</code> - Show recent transactions\n"
-            "📊 <code>/export</code> - Export weekly summaries as csv\n"
+            "📊 <code>/export</code> - Export weekly summaries as Parquet\n"
+            "📊 <code>/export_csv</code> - Export weekly summaries as csv\n"
             "📊 <code>/weekly_summary</code> - View weekly financial summary\n"
             "<b>Image Recognition:</b>\n"
             "📸 Just send me a photo of your receipt/bill and I'll extract the details automatically!\n\n"
@@ -175,24 +548,24 @@ class BotHandlers:
         )
         await update.message.reply_text(welcome_text, parse_mode='HTML')
 
+    @staticmethod
+    async def _persist_user_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Write the user's conversation state through to persistence right away.
+
+        Persistence reloads user_data before every update but only saves it
+        every update_interval, so unsaved changes would otherwise be replaced
+        by the older stored copy on the user's next message.
+        """
+        context.application.mark_data_for_update_persistence(user_ids=update.effective_user.id)
+        await context.application.update_persistence()
+
     async def add_transaction(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await self._add_transaction(update, context)
 
     async def _add_transaction(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        categories = self.finance_bot.get_categories()
-        keyboard = []
-        for i in range(0, len(categories), 2):
-            row = []
-            for j in range(2):
-                if i + j < len(categories):
-                    cat_name, emoji, _ = categories[i + j]
-                    row.append(InlineKeyboardButton(
-                        f"{emoji} {cat_name}",
-                        callback_data=f"category_{cat_name}"
-                    ))
-            keyboard.append(row)
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = await self.finance_bot._get_category_keyboard()
         context.user_data['awaiting'] = 'category'
+        await self._persist_user_data(update, context)
         await update.message.reply_text(
             f"💵 Adding a transaction. Please select a category:",
             reply_markup=reply_markup,
@@ -205,6 +578,7 @@ class BotHandlers:
         _, category = query.data.split('_', 1)
         context.user_data['category'] = category
         context.user_data['awaiting'] = 'amount'
+        await self._persist_user_data(update, context)
         await query.edit_message_text(
             f"Category selected: <b>{category}</b>\n\n💵 Please enter the amount:",
             parse_mode='HTML'
@@ -218,6 +592,7 @@ class BotHandlers:
                 amount = float(update.message.text)
                 context.user_data['amount'] = amount
                 context.user_data['awaiting'] = 'description'
+                await self._persist_user_data(update, context)
                 await update.message.reply_text(
                     f"Amount: <b>${amount:.2f}</b>\n\n📝 Please enter a description (or send /skip):",
                     parse_mode='HTML'
@@ -225,45 +600,38 @@ class BotHandlers:
             except ValueError:
                 await update.message.reply_text("❌ Invalid amount. Please enter a number.")
         elif context.user_data['awaiting'] == 'description':
-            description = update.message.text
-            user = update.effective_user
-            category = context.user_data['category']
-            amount = context.user_data['amount']
-            self.finance_bot.add_transaction(
-                user_id=user.id,
-                amount=amount,
-                category=category,
-                description=description
-            )
-            transaction_emoji = "💵"
-            await update.message.reply_text(
-                f"✅ {transaction_emoji} Transaction added successfully!\n\n"
-                f"<b>Category:</b> {category}\n"
-                f"<b>Amount:</b> ${amount:.2f}\n"
-                f"<b>Description:</b> {description}",
-                parse_mode='HTML'
-            )
-            context.user_data.clear()
+            await self._finalize_transaction(update, context, update.message.text)
 
     async def skip_description(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if context.user_data.get('awaiting') == 'description':
-            user = update.effective_user
-            category = context.user_data['category']
-            amount = context.user_data['amount']
-            self.finance_bot.add_transaction(
-                user_id=user.id,
+            await self._finalize_transaction(update, context, None)
+
+    async def _finalize_transaction(self, update: Update, context: ContextTypes.DEFAULT_TYPE, description: Optional[str]):
+        """Save the transaction collected in user_data and confirm it; a None description was skipped"""
+        user_data = context.user_data
+        category = user_data['category']
+        amount = user_data['amount']
+        try:
+            await self.finance_bot.add_transaction(
+                user_id=update.effective_user.id,
                 amount=amount,
                 category=category,
-                description="No description"
+                description=description if description is not None else "No description"
             )
-            transaction_emoji = "💵"
-            await update.message.reply_text(
-                f"✅ {transaction_emoji} Transaction added successfully!\n\n"
-                f"<b>Category:</b> {category}\n"
-                f"<b>Amount:</b> ${amount:.2f}",
-                parse_mode='HTML'
-            )
-            context.user_data.clear()
+        except Exception as e:
+            logger.error(f"Error saving transaction: {e}")
+            await update.message.reply_text("❌ Could not save the transaction. Please try again.")
+            return
+        text = (
+            f"✅ {self.TRANSACTION_EMOJI} Transaction added successfully!\n\n"
+            f"<b>Category:</b> {category}\n"
+            f"<b>Amount:</b> ${amount:.2f}"
+        )
+        if description is not None:
+            text += f"\n<b>Description:</b> {description}"
+        user_data.clear()
+        await self._persist_user_data(update, context)
+        await update.message.reply_text(text, parse_mode='HTML')
 
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("📸 Processing your receipt... This may take a moment.")
@@ -272,8 +640,8 @@ class BotHandlers:
             file = await context.bot.get_file(photo.file_id)
             image_data = BytesIO()
             await file.download_to_memory(image_data)
-            image_bytes = image_data.getvalue()
-            result = await self.finance_bot.process_image_with_gpt4v(image_bytes)
+            image_bytes = await asyncio.to_thread(_compress_receipt, image_data)
+            result = await self.finance_bot.process_image_with_gpt4v(image_bytes, update.effective_chat.id)
             if "error" in result:
                 await update.message.reply_text(f"❌ Error processing receipt: {result['error']}")
                 return
@@ -287,6 +655,7 @@ class BotHandlers:
                 "Would you like to save this transaction?"
             )
             context.user_data['extracted_data'] = result
+            await self._persist_user_data(update, context)
             keyboard = [
                 [InlineKeyboardButton("✅ Save Transaction", callback_data="save_extracted")],
                 [InlineKeyboardButton("❌ Cancel", callback_data="cancel_extracted")]
@@ -304,7 +673,7 @@ class BotHandlers:
             extracted_data = context.user_data.get('extracted_data', {})
             user = update.effective_user
             try:
-                self.finance_bot.add_transaction(
+                await self.finance_bot.add_transaction(
                     user_id=user.id,
                     amount=float(extracted_data.get('amount', 0)),
                     category=extracted_data.get('category', 'Other Expenses'),
@@ -317,81 +686,86 @@ class BotHandlers:
         elif query.data == "cancel_extracted":
             await query.edit_message_text("❌ Receipt processing cancelled.")
         context.user_data.pop('extracted_data', None)
+        await self._persist_user_data(update, context)
 
     async def recent_transactions(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        transactions = self.finance_bot.get_user_transactions(user.id, days=7)
+        transactions = await self.finance_bot.get_user_transactions(user.id, days=7, limit=10)
         if not transactions:
             await update.message.reply_text("📋 No recent transactions found.")
             return
         recent_text = "<b>📋 Recent Transactions (Last 7 Days):</b>\n\n"
 
-        # Fetch all categories for mapping
-        cat_records = self.finance_bot.supabase.table("base_categories").select("id,name").execute().data
-        cat_map = {c["id"]: c["name"] for c in cat_records}
-        for t in transactions[:10]:
+        for t in transactions:
             emoji = "💵"
-            # Map category_id to category name
-            cat_name = cat_map.get(t.get('category_id'), 'Unknown')
+            cat_name = (t.get('base_categories') or {}).get('name', 'Unknown')
             recent_text += f"{emoji} ${t['amount']:.2f} - {cat_name}\n"
             recent_text += f"   📝 {t.get('description', '')}\n"
             recent_text += f"   📅 {t.get('date', '')}\n\n"
         await update.message.reply_text(recent_text, parse_mode='HTML')
     
     async def export(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        from export_handler import export_parquet
+        await self._send_export(update, export_parquet, caption="Parquet (open with pandas/DuckDB)")
+
+    async def export_csv(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        from export_handler import export_csv
+        await self._send_export(update, export_csv)
+
+    async def _send_export(self, update: Update, exporter, caption: Optional[str] = None):
         user = update.effective_user
-        user_row = self.finance_bot.supabase.table("users").select("id").eq("telegram_id", user.id).single().execute().data
-        if not user_row:
-            await update.message.reply_text("User not found. Please /start first.")
-            return
-        user_id = user_row["id"]
-        csv_path = export_csv(self.finance_bot.supabase, user_id)
-        if not csv_path:
+        cat_map = await self.finance_bot.load_category_map()
+        export_path = await self.finance_bot._run_db(exporter, self.finance_bot.supabase, user.id, 7, cat_map)
+        if not export_path:
             await update.message.reply_text("No data found for export.")
             return
-        with open(csv_path, "rb") as f:
-            await update.message.reply_document(document=f, filename=os.path.basename(csv_path))
-        os.remove(csv_path)  # Clean up after sending
+        with open(export_path, "rb") as f:
+            await update.message.reply_document(document=f, filename=os.path.basename(export_path), caption=caption)
+        os.remove(export_path)  # Clean up after sending
 
     async def weekly_summary(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        from export_handler import generate_weekly_summary
         user = update.effective_user
-        user_row = self.finance_bot.supabase.table("users").select("id").eq("telegram_id", user.id).single().execute().data
-        if not user_row:
-            await update.message.reply_text("User not found. Please /start first.")
-            return
-        user_id = user_row["id"]
-        trend_img_path, summary_text, pie_img_path = generate_weekly_summary(self.finance_bot.supabase, user_id)
-        if trend_img_path and pie_img_path:
-            # Send both images as an album, with summary as caption on the pie chart
-            media = [
-                {"type": "photo", "media": open(trend_img_path, "rb")},
-                {"type": "photo", "media": open(pie_img_path, "rb"), "caption": summary_text, "parse_mode": "HTML"}
-            ]
-            # Telegram API does not accept dicts, but PTB has InputMediaPhoto, so you may need:
-            from telegram import InputMediaPhoto
-            await update.message.reply_media_group([
-                InputMediaPhoto(open(trend_img_path, "rb")),
-                InputMediaPhoto(open(pie_img_path, "rb"), caption=summary_text, parse_mode="HTML")
-            ])
-            # Clean up
-            os.remove(trend_img_path)
-            os.remove(pie_img_path)
-        elif trend_img_path:
-            with open(trend_img_path, "rb") as img:
-                await update.message.reply_photo(img, caption=summary_text, parse_mode="HTML")
-            os.remove(trend_img_path)
-        else:
+        trend_buf, summary_text, pie_buf = await generate_weekly_summary(
+            self.finance_bot.supabase, user.id, run_db=self.finance_bot._run_db
+        )
+        if not trend_buf:
             await update.message.reply_text(summary_text)
+            return
+        # Send both images as an album, with summary as caption on the pie chart
+        await update.message.reply_media_group([
+            InputMediaPhoto(trend_buf),
+            InputMediaPhoto(pie_buf, caption=summary_text, parse_mode="HTML")
+        ])
 
 def main():
     finance_bot = FinanceBot(config)
     handlers = BotHandlers(finance_bot)
-    application = Application.builder().token(config.BOT_TOKEN).build()
+
+    async def post_init(application: Application):
+        await finance_bot.warm_up()
+
+    async def post_shutdown(application: Application):
+        await finance_bot.aclose()
+
+    # Keeps replies within Telegram's global and per-group limits and retries on RetryAfter
+    rate_limiter = AIORateLimiter(max_retries=3)
+
+    builder = Application.builder() \
+        .token(config.BOT_TOKEN) \
+        .rate_limiter(rate_limiter) \
+        .post_init(post_init) \
+        .post_shutdown(post_shutdown)
+    if config.REDIS_URL:
+        from redis_persistence import RedisPersistence
+        builder = builder.persistence(RedisPersistence(config.REDIS_URL))
+    application = builder.build()
     application.add_handler(CommandHandler("start", handlers.start))
     application.add_handler(CommandHandler("add_transaction", handlers.add_transaction))
     application.add_handler(CommandHandler("recent", handlers.recent_transactions))
     application.add_handler(CommandHandler("skip", handlers.skip_description))
     application.add_handler(CommandHandler("export", handlers.export))
+    application.add_handler(CommandHandler("export_csv", handlers.export_csv))
     application.add_handler(CommandHandler("weekly_summary", handlers.weekly_summary))  
     application.add_handler(CallbackQueryHandler(
         handlers.handle_category_selection,
@@ -0,0 +1,91 @@
+# redis_persistence.py
+import json
+from typing import Dict, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+
+class RedisPersistence(BasePersistence):
+    """Keeps each user's conversation state (context.user_data) in Redis.
+
+    The state survives restarts, and several bot workers can share it:
+    user_data is reloaded from Redis before every update, so the handlers
+    write it back as soon as they change it rather than waiting for the
+    `update_interval` flush. Chat, bot and callback data are not stored.
+    """
+
+    def __init__(self, url: str, prefix: str = "finance_bot", update_interval: float = 1):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        from redis.asyncio import Redis
+
+        self._redis = Redis.from_url(url)
+        self._prefix = f"{prefix}:user_data:"
+
+    def _key(self, user_id: int) -> str:
+        return f"{self._prefix}{user_id}"
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        user_data = {}
+        async for key in self._redis.scan_iter(match=f"{self._prefix}*"):
+            raw = await self._redis.get(key)
+            if raw is not None:
+                user_data[int(key.decode()[len(self._prefix):])] = json.loads(raw)
+        return user_data
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        # The add-transaction flow clears user_data when it finishes, so empty means done
+        if data:
+            await self._redis.set(self._key(user_id), json.dumps(data))
+        else:
+            await self._redis.delete(self._key(user_id))
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        # Another worker may have moved this user's flow on since we last saw it
+        raw = await self._redis.get(self._key(user_id))
+        user_data.clear()
+        if raw is not None:
+            user_data.update(json.loads(raw))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._redis.delete(self._key(user_id))
+
+    async def flush(self) -> None:
+        await self._redis.aclose()
+
+    # Only user_data is persisted; the remaining hooks are no-ops.
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> Optional[tuple]:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: tuple) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
@@ -0,0 +1,69 @@
+-- Database objects used by finance_bot.py.
+-- Run this in the Supabase SQL editor after creating the users,
+-- base_categories and expenditures tables. Everything runs in one
+-- transaction, so a failed statement leaves no half-applied setup behind.
+
+BEGIN;
+
+-- Inserts an expenditure for a telegram user, resolving the user uuid and
+-- category id server-side so a save costs a single round-trip.
+-- Returns the inserted row, or no rows if the user or category is unknown.
+CREATE OR REPLACE FUNCTION insert_expenditure(
+    p_telegram_id bigint,
+    p_amount numeric,
+    p_category text,
+    p_description text,
+    p_date date DEFAULT CURRENT_DATE
+) RETURNS SETOF expenditures
+LANGUAGE sql
+AS $$
+    INSERT INTO expenditures (user_id, amount, currency, date, category_id, description, input_method)
+    SELECT u.id, p_amount, 'SGD', p_date, c.id, p_description, 'manual'
+    FROM users u, base_categories c
+    WHERE u.telegram_id = p_telegram_id
+      AND c.name = p_category
+    RETURNING *;
+$$;
+
+-- Serves the per-user "latest first" reads (/recent) as an index scan
+-- instead of sorting all of a user's expenditures.
+CREATE INDEX IF NOT EXISTS idx_expenditures_user_date ON expenditures (user_id, date DESC);
+
+-- Per-day, per-category totals for /weekly_summary, looked up by telegram id
+-- so the bot does not need a separate users query first. Aggregating here
+-- keeps the response at most days x categories rows however much was spent.
+CREATE OR REPLACE FUNCTION weekly_summary_data(
+    p_telegram_id bigint,
+    p_days int DEFAULT 7
+) RETURNS TABLE (date date, amount numeric, category_name text)
+LANGUAGE sql STABLE
+AS $$
+    SELECT e.date, SUM(e.amount), COALESCE(c.name, 'Unknown')
+    FROM expenditures e
+    JOIN users u ON u.id = e.user_id
+    LEFT JOIN base_categories c ON c.id = e.category_id
+    WHERE u.telegram_id = p_telegram_id
+      AND e.date BETWEEN CURRENT_DATE - p_days AND CURRENT_DATE
+    GROUP BY e.date, COALESCE(c.name, 'Unknown');
+$$;
+
+-- One page of a telegram user's expenditures for /export and /export_csv.
+CREATE OR REPLACE FUNCTION export_rows(
+    p_telegram_id bigint,
+    p_days int DEFAULT 7,
+    p_offset int DEFAULT 0,
+    p_limit int DEFAULT 500
+) RETURNS SETOF expenditures
+LANGUAGE sql STABLE
+AS $$
+    SELECT e.*
+    FROM expenditures e
+    JOIN users u ON u.id = e.user_id
+    WHERE u.telegram_id = p_telegram_id
+      AND e.date BETWEEN CURRENT_DATE - p_days AND CURRENT_DATE
+    ORDER BY e.date, e.id
+    OFFSET p_offset
+    LIMIT p_limit;
+$$;
+
+COMMIT;